@@ -1,40 +1,202 @@
 from __future__ import annotations
 
 import os
+import queue
 import random
 import sqlite3
 import threading
 import time
-from contextlib import closing
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager
 from dataclasses import dataclass
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from typing import Any, TypeVar
 
+from apscheduler.executors.pool import ThreadPoolExecutor as JobThreadPool
 from apscheduler.schedulers.background import BackgroundScheduler
 from dateutil.relativedelta import relativedelta
-from flask import Flask, g, redirect, render_template, request, url_for
+from flask import Flask, Response, g, redirect, request, stream_template, url_for
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(APP_DIR, "dami_crm.db")
 
+WRITE_RETRY_DELAYS = (0.1, 0.2, 0.4)
+STATS_TTL_SECONDS = 30
+CLIENTS_PAGE_SIZE = 50
+READ_POOL_SIZE = 4
+# pywhatkit sends are serialized by _whatsapp_lock anyway, so extra workers
+# there would only wait on the lock.
+_DEFAULT_SEND_WORKERS = "1" if os.getenv("WHATSAPP_MODE", "stub").lower() == "pywhatkit" else "4"
+SEND_WORKERS = max(int(os.getenv("WHATSAPP_WORKERS", _DEFAULT_SEND_WORKERS)), 1)
+
+T = TypeVar("T")
+
 app = Flask(__name__)
+# Campaign jobs get their own single-thread executor so one campaign's sends
+# go out in order; _whatsapp_lock is what keeps them from overlapping the
+# daily batch's sends.
+scheduler = BackgroundScheduler(executors={"default": JobThreadPool(10), "campaign": JobThreadPool(1)})
+_scheduler_lock = threading.Lock()
+# pywhatkit drives a single WhatsApp Web tab; every send, whether from a
+# campaign job or the daily batch, takes this lock so they never overlap.
+_whatsapp_lock = threading.Lock()
+_send_pool = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix="whatsapp")
+
+# Statements shared by several write paths.
+# The client may be deleted while a send is in flight; the subquery stores
+# NULL instead of failing the foreign key, so the log row is still written.
+INSERT_LOG_SQL = """
+    INSERT INTO message_log (client_id, phone, message, message_type, status, created_at, error)
+    SELECT (SELECT id FROM clients WHERE id = ?), ?, ?, ?, ?, ?, ?
+"""
+UPDATE_TASK_SENT_SQL = "UPDATE tasks SET status = 'sent', sent_at = ? WHERE id = ?"
+UPDATE_TASK_FAILED_SQL = "UPDATE tasks SET status = 'failed', error = ? WHERE id = ?"
+UPDATE_TASK_STATUS_SQL = "UPDATE tasks SET status = ?, sent_at = COALESCE(sent_at, ?) WHERE id = ?"
+UPDATE_CLIENT_LAST_CONTACTED_SQL = "UPDATE clients SET last_contacted = ? WHERE id = ?"
+UPDATE_CLIENT_SQL = """
+    UPDATE clients
+    SET name = ?, phone = ?, birth_date = ?, last_appointment = ?, last_contacted = ?
+    WHERE id = ?
+"""
+
+
+def _configure(conn: sqlite3.Connection) -> sqlite3.Connection:
+    # WAL keeps dashboard reads from blocking the scheduler writer and lets
+    # synchronous=NORMAL skip the fsync on most commits.
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA busy_timeout = 5000")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -8000")
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+# All writes go through one shared connection serialized by _write_lock, so
+# the scheduler, campaign jobs and HTTP routes never race for SQLite's
+# write lock. Request handlers borrow a read-only connection from a small
+# pool, so a request does not pay for sqlite3.connect() and the PRAGMAs.
+_write_conn: sqlite3.Connection | None = None
+_write_lock = threading.Lock()
+_read_pool: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+
+
+def _get_write_conn() -> sqlite3.Connection:
+    global _write_conn
+    if _write_conn is None:
+        _write_conn = _configure(sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None))
+        _write_conn.row_factory = sqlite3.Row
+    return _write_conn
+
+
+def _retry_write(fn: Callable[..., T], *args: object, **kwargs: object) -> T:
+    # Another process (e.g. the debug reloader) can still hold the database
+    # lock past busy_timeout; back off 100/200/400 ms before giving up.
+    for delay in WRITE_RETRY_DELAYS:
+        try:
+            return fn(*args, **kwargs)
+        except sqlite3.OperationalError as exc:
+            reason = str(exc).lower()
+            if "locked" not in reason and "busy" not in reason:
+                raise
+            time.sleep(delay)
+    return fn(*args, **kwargs)
+
+
+@contextmanager
+def write_db() -> Iterator[sqlite3.Connection]:
+    # Transactions are opened explicitly with BEGIN IMMEDIATE so the write
+    # lock is taken up front; a deferred read-then-write transaction (the
+    # bulk routes, toggle_task) can otherwise fail with SQLITE_BUSY on upgrade.
+    with _write_lock:
+        conn = _get_write_conn()
+        _retry_write(conn.execute, "BEGIN IMMEDIATE")
+        try:
+            yield conn
+            _retry_write(conn.commit)
+        except BaseException:
+            conn.rollback()
+            raise
+        _stats_cache["gen"] += 1
+        _stats_cache["v"] = None
 
 
 def get_db() -> sqlite3.Connection:
     if "db" not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
+        try:
+            g.db = _read_pool.get_nowait()
+        except queue.Empty:
+            g.db = _configure(sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False))
+            g.db.row_factory = sqlite3.Row
     return g.db
 
 
 @app.teardown_appcontext
 def close_db(_exc: Exception | None) -> None:
     db = g.pop("db", None)
-    if db is not None:
+    if db is None:
+        return
+    try:
+        _read_pool.put_nowait(db)
+    except queue.Full:
         db.close()
 
 
+TASKS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        client_id INTEGER NOT NULL,
+        task_type TEXT NOT NULL,
+        scheduled_for TEXT NOT NULL,
+        status TEXT NOT NULL,
+        message TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        sent_at TEXT,
+        error TEXT,
+        FOREIGN KEY (client_id) REFERENCES clients (id) ON DELETE CASCADE
+    )
+"""
+MESSAGE_LOG_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        client_id INTEGER,
+        phone TEXT NOT NULL,
+        message TEXT NOT NULL,
+        message_type TEXT NOT NULL,
+        status TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        error TEXT,
+        FOREIGN KEY (client_id) REFERENCES clients (id) ON DELETE CASCADE
+    )
+"""
+
+
+TASKS_COLUMNS = (
+    "id, client_id, task_type, scheduled_for, status, message, created_at, sent_at, error"
+)
+MESSAGE_LOG_COLUMNS = "id, client_id, phone, message, message_type, status, created_at, error"
+
+
+def _ensure_cascade(db: sqlite3.Connection, table: str, create_sql: str, columns: str) -> None:
+    # Databases created before ON DELETE CASCADE keep the old foreign key and
+    # SQLite cannot alter a constraint in place, so rebuild the table once.
+    foreign_keys = db.execute(f"PRAGMA foreign_key_list({table})").fetchall()
+    if all(fk["on_delete"] == "CASCADE" for fk in foreign_keys):
+        return
+    # One explicit transaction: the legacy isolation mode would otherwise
+    # autocommit the CREATE on its own and leave a half-done rebuild behind.
+    with db:
+        db.execute("BEGIN")
+        db.execute(create_sql.format(table=f"{table}_new"))
+        db.execute(f"INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}")
+        db.execute(f"DROP TABLE {table}")
+        db.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
 def init_db() -> None:
-    with closing(sqlite3.connect(DB_PATH)) as db:
+    with closing(_configure(sqlite3.connect(DB_PATH))) as db:
+        db.row_factory = sqlite3.Row
         db.execute(
             """
             CREATE TABLE IF NOT EXISTS clients (
@@ -48,37 +210,50 @@ def init_db() -> None:
             )
             """
         )
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute(TASKS_TABLE_SQL.format(table="tasks"))
+        db.execute(MESSAGE_LOG_TABLE_SQL.format(table="message_log"))
+        db.commit()
+        # The copy in _ensure_cascade must not trip over orphaned rows left
+        # by older versions; the pragma only takes effect outside a transaction.
+        db.execute("PRAGMA foreign_keys = OFF")
+        _ensure_cascade(db, "tasks", TASKS_TABLE_SQL, TASKS_COLUMNS)
+        _ensure_cascade(db, "message_log", MESSAGE_LOG_TABLE_SQL, MESSAGE_LOG_COLUMNS)
+        db.execute("PRAGMA foreign_keys = ON")
+        # Tasks claimed by a run that died mid-batch go back to the queue.
+        db.execute("UPDATE tasks SET status = 'pending' WHERE status = 'sending'")
         db.execute(
             """
-            CREATE TABLE IF NOT EXISTS tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                client_id INTEGER NOT NULL,
-                task_type TEXT NOT NULL,
-                scheduled_for TEXT NOT NULL,
-                status TEXT NOT NULL,
-                message TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                sent_at TEXT,
-                error TEXT,
-                FOREIGN KEY (client_id) REFERENCES clients (id)
-            )
+            CREATE INDEX IF NOT EXISTS idx_tasks_client_type_created
+            ON tasks (client_id, task_type, created_at)
             """
         )
         db.execute(
             """
-            CREATE TABLE IF NOT EXISTS message_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                client_id INTEGER,
-                phone TEXT NOT NULL,
-                message TEXT NOT NULL,
-                message_type TEXT NOT NULL,
-                status TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                error TEXT,
-                FOREIGN KEY (client_id) REFERENCES clients (id)
-            )
+            CREATE INDEX IF NOT EXISTS idx_tasks_status_sched
+            ON tasks (status, scheduled_for)
             """
         )
+        db.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_clients_birth_mmdd
+            ON clients (substr(birth_date, 6, 5))
+            """
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS idx_clients_name ON clients (name)")
+        db.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_tasks_created
+            ON tasks (created_at DESC, client_id, status, task_type, scheduled_for)
+            """
+        )
+        db.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_messagelog_created
+            ON message_log (created_at DESC)
+            """
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS idx_log_client_id ON message_log (client_id)")
         db.commit()
 
 
@@ -86,12 +261,6 @@ def today_str() -> str:
     return date.today().isoformat()
 
 
-def parse_date(value: str | None) -> date | None:
-    if not value:
-        return None
-    return datetime.strptime(value, "%Y-%m-%d").date()
-
-
 def log_message(
     client_id: int | None,
     phone: str,
@@ -100,15 +269,11 @@ def log_message(
     status: str,
     error: str | None = None,
 ) -> None:
-    db = get_db()
-    db.execute(
-        """
-        INSERT INTO message_log (client_id, phone, message, message_type, status, created_at, error)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-        (client_id, phone, message, message_type, status, datetime.now().isoformat(), error),
-    )
-    db.commit()
+    with write_db() as db:
+        db.execute(
+            INSERT_LOG_SQL,
+            (client_id, phone, message, message_type, status, datetime.now().isoformat(), error),
+        )
 
 
 def send_whatsapp_message(phone: str, message: str, image_path: str | None = None) -> None:
@@ -116,115 +281,163 @@ def send_whatsapp_message(phone: str, message: str, image_path: str | None = Non
     if mode == "pywhatkit":
         import pywhatkit
 
-        if image_path:
-            pywhatkit.sendwhats_image(
-                phone,
-                image_path,
-                caption=message,
-                wait_time=15,
-                tab_close=True,
-                close_time=3,
-            )
-        else:
-            pywhatkit.sendwhatmsg_instantly(
-                phone,
-                message,
-                wait_time=15,
-                tab_close=True,
-                close_time=3,
-            )
+        with _whatsapp_lock:
+            if image_path:
+                pywhatkit.sendwhats_image(
+                    phone,
+                    image_path,
+                    caption=message,
+                    wait_time=15,
+                    tab_close=True,
+                    close_time=3,
+                )
+            else:
+                pywhatkit.sendwhatmsg_instantly(
+                    phone,
+                    message,
+                    wait_time=15,
+                    tab_close=True,
+                    close_time=3,
+                )
     else:
         print(f"[STUB] WhatsApp to {phone}: {message}")
 
 
-def create_task_if_missing(
-    client_id: int,
+def _insert_due_tasks(
+    db: sqlite3.Connection,
+    today: date,
+    now_iso: str,
     task_type: str,
-    scheduled_for: date,
-    message: str,
+    message_sql: str,
+    due_sql: str,
+    due_params: tuple[str, ...],
     cooldown_days: int,
 ) -> None:
-    db = get_db()
-    cutoff = (date.today() - relativedelta(days=cooldown_days)).isoformat()
-    existing = db.execute(
-        """
-        SELECT 1 FROM tasks
-        WHERE client_id = ? AND task_type = ? AND created_at >= ?
-        LIMIT 1
-        """,
-        (client_id, task_type, cutoff),
-    ).fetchone()
-    if existing:
-        return
+    # One INSERT ... SELECT per task type; the NOT EXISTS guard skips clients
+    # that already got this task type within the cooldown window.
+    cutoff = (today - timedelta(days=cooldown_days)).isoformat()
     db.execute(
-        """
+        f"""
         INSERT INTO tasks (client_id, task_type, scheduled_for, status, message, created_at)
-        VALUES (?, ?, ?, ?, ?, ?)
+        SELECT id, ?, ?, 'pending', {message_sql}, ?
+        FROM clients
+        WHERE {due_sql}
+          AND NOT EXISTS (
+              SELECT 1 FROM tasks
+              WHERE tasks.client_id = clients.id AND tasks.task_type = ? AND tasks.created_at >= ?
+          )
         """,
-        (client_id, task_type, scheduled_for.isoformat(), "pending", message, datetime.now().isoformat()),
+        (task_type, today.isoformat(), now_iso, *due_params, task_type, cutoff),
     )
-    db.commit()
+
+
+def _reset_generation_marker(db: sqlite3.Connection) -> None:
+    # Called when clients or tasks change in a way that can make a new task
+    # due, so the next generate_daily_tasks run today is not skipped.
+    db.execute("DELETE FROM meta WHERE key = 'last_gen'")
+
+
+def _cut_reminder_cutoff(today: date) -> date:
+    # Latest last_appointment whose "+3 months" (clamped to month end by
+    # relativedelta) falls on or before today. On the last day of a month
+    # every later day of the month 3 months back clamps onto today too.
+    cutoff = today - relativedelta(months=3)
+    if (today + timedelta(days=1)).day == 1:
+        cutoff += relativedelta(day=31)
+    return cutoff
 
 
 def generate_daily_tasks() -> None:
-    db = get_db()
     today = date.today()
-    rows = db.execute("SELECT * FROM clients").fetchall()
-    for row in rows:
-        birth = parse_date(row["birth_date"])
-        last_appt = parse_date(row["last_appointment"])
-        last_contacted = parse_date(row["last_contacted"])
-
-        if last_appt:
-            due_cut = last_appt + relativedelta(months=3)
-            if due_cut <= today:
-                message = f"Oi {row['name']}! Já faz 3 meses do último corte. Quer agendar um horário?"
-                create_task_if_missing(row["id"], "cut_reminder", today, message, cooldown_days=60)
-
-        if last_contacted:
-            days_no_contact = (today - last_contacted).days
-            if days_no_contact >= 20:
-                message = f"Oi {row['name']}! Tudo bem? Passando pra deixar um carinho 💛"
-                create_task_if_missing(row["id"], "affection", today, message, cooldown_days=10)
-
-        if birth and birth.month == today.month and birth.day == today.day:
-            message = (
-                f"Parabéns, {row['name']}! Que seu dia seja lindo e cheio de luz ✨ "
-                "Quando quiser, estou aqui!"
-            )
-            create_task_if_missing(row["id"], "birthday", today, message, cooldown_days=300)
+    now_iso = datetime.now().isoformat()
+    with write_db() as db:
+        last_gen = db.execute("SELECT value FROM meta WHERE key = 'last_gen'").fetchone()
+        if last_gen and last_gen["value"] == today.isoformat():
+            return
+        _insert_due_tasks(
+            db,
+            today,
+            now_iso,
+            "cut_reminder",
+            "'Oi ' || name || '! Já faz 3 meses do último corte. Quer agendar um horário?'",
+            "last_appointment IS NOT NULL AND last_appointment <= ?",
+            (_cut_reminder_cutoff(today).isoformat(),),
+            cooldown_days=60,
+        )
+        _insert_due_tasks(
+            db,
+            today,
+            now_iso,
+            "affection",
+            "'Oi ' || name || '! Tudo bem? Passando pra deixar um carinho 💛'",
+            "last_contacted IS NOT NULL AND last_contacted <= ?",
+            ((today - timedelta(days=20)).isoformat(),),
+            cooldown_days=10,
+        )
+        _insert_due_tasks(
+            db,
+            today,
+            now_iso,
+            "birthday",
+            "'Parabéns, ' || name || '! Que seu dia seja lindo e cheio de luz ✨ Quando quiser, estou aqui!'",
+            "birth_date IS NOT NULL AND substr(birth_date, 6, 5) = ?",
+            (today.strftime("%m-%d"),),
+            cooldown_days=300,
+        )
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_gen', ?)", (today.isoformat(),))
+
+
+def _send_task(task: dict[str, Any]) -> tuple[dict[str, Any], str | None]:
+    try:
+        send_whatsapp_message(task["phone"], task["message"])
+    except Exception as exc:  # pragma: no cover - best effort
+        return task, str(exc)
+    return task, None
+
+
+def _record_task_result(task: dict[str, Any], error: str | None, today_iso: str) -> None:
+    now_iso = datetime.now().isoformat()
+    with write_db() as db:
+        if error is None:
+            db.execute(UPDATE_TASK_SENT_SQL, (now_iso, task["id"]))
+            db.execute(UPDATE_CLIENT_LAST_CONTACTED_SQL, (today_iso, task["client_id"]))
+        else:
+            db.execute(UPDATE_TASK_FAILED_SQL, (error, task["id"]))
+        db.execute(
+            INSERT_LOG_SQL,
+            (
+                task["client_id"],
+                task["phone"],
+                task["message"],
+                task["task_type"],
+                "sent" if error is None else "failed",
+                now_iso,
+                error,
+            ),
+        )
 
 
 def process_pending_tasks() -> None:
-    db = get_db()
-    pending = db.execute(
-        """
-        SELECT tasks.*, clients.phone
-        FROM tasks
-        JOIN clients ON clients.id = tasks.client_id
-        WHERE tasks.status = 'pending' AND tasks.scheduled_for <= ?
-        """,
-        (today_str(),),
-    ).fetchall()
-    for task in pending:
-        try:
-            send_whatsapp_message(task["phone"], task["message"])
-            db.execute(
-                "UPDATE tasks SET status = 'sent', sent_at = ? WHERE id = ?",
-                (datetime.now().isoformat(), task["id"]),
-            )
-            db.execute(
-                "UPDATE clients SET last_contacted = ? WHERE id = ?",
-                (today_str(), task["client_id"]),
-            )
-            log_message(task["client_id"], task["phone"], task["message"], task["task_type"], "sent")
-        except Exception as exc:  # pragma: no cover - best effort
-            db.execute(
-                "UPDATE tasks SET status = 'failed', error = ? WHERE id = ?",
-                (str(exc), task["id"]),
-            )
-            log_message(task["client_id"], task["phone"], task["message"], task["task_type"], "failed", str(exc))
-        db.commit()
+    today_iso = today_str()
+    # Claim the due tasks before sending so an overlapping run (cron plus
+    # "Rodar agora") cannot pick the same rows up and message them twice.
+    with write_db() as db:
+        pending = db.execute(
+            """
+            SELECT tasks.id, tasks.client_id, tasks.task_type, tasks.message, clients.phone
+            FROM tasks
+            JOIN clients ON clients.id = tasks.client_id
+            WHERE tasks.status = 'pending' AND tasks.scheduled_for <= ?
+            """,
+            (today_iso,),
+        ).fetchall()
+        db.executemany("UPDATE tasks SET status = 'sending' WHERE id = ?", [(task["id"],) for task in pending])
+    # Sends are slow (pywhatkit drives a browser), so fan them out over the
+    # pool and record each outcome as soon as it is known.
+    futures = [_send_pool.submit(_send_task, dict(task)) for task in pending]
+    for future in as_completed(futures):
+        task, error = future.result()
+        _record_task_result(task, error, today_iso)
 
 
 def daily_scheduler_job() -> None:
@@ -233,10 +446,15 @@ def daily_scheduler_job() -> None:
         process_pending_tasks()
 
 
+def ensure_scheduler_running() -> None:
+    with _scheduler_lock:
+        if not scheduler.running:
+            scheduler.start()
+
+
 def schedule_jobs() -> BackgroundScheduler:
-    scheduler = BackgroundScheduler()
     scheduler.add_job(daily_scheduler_job, "cron", hour=9, minute=0, id="daily_whatsapp")
-    scheduler.start()
+    ensure_scheduler_running()
     return scheduler
 
 
@@ -247,7 +465,19 @@ class DashboardStats:
     birthdays_today: int
 
 
+# Dashboard counts are cached briefly. write_db() bumps "gen" after every
+# commit; "v" holds (gen, timestamp, stats) and is only served while its
+# generation is current, so counts computed across a write are never reused.
+_stats_cache: dict[str, Any] = {"gen": 0, "v": None}
+
+
 def get_dashboard_stats() -> DashboardStats:
+    gen = _stats_cache["gen"]
+    cached = _stats_cache["v"]
+    if cached is not None:
+        cached_gen, cached_at, stats = cached
+        if cached_gen == gen and time.monotonic() - cached_at < STATS_TTL_SECONDS:
+            return stats
     db = get_db()
     total_clients = db.execute("SELECT COUNT(*) FROM clients").fetchone()[0]
     pending_tasks = db.execute("SELECT COUNT(*) FROM tasks WHERE status = 'pending'").fetchone()[0]
@@ -260,37 +490,59 @@ def get_dashboard_stats() -> DashboardStats:
         """,
         (today.strftime("%m-%d"),),
     ).fetchone()[0]
-    return DashboardStats(total_clients, pending_tasks, birthdays_today)
+    stats = DashboardStats(total_clients, pending_tasks, birthdays_today)
+    _stats_cache["v"] = (gen, time.monotonic(), stats)
+    return stats
 
 
 @app.route("/", methods=["GET"])
-def index() -> str:
+def index() -> Response:
+    stats = get_dashboard_stats()
+    # Clamp to the last page so huge ?page= values cannot overflow the OFFSET.
+    last_page = max((stats.total_clients + CLIENTS_PAGE_SIZE - 1) // CLIENTS_PAGE_SIZE, 1)
+    page = min(max(request.args.get("page", 1, type=int), 1), last_page)
     db = get_db()
-    clients = db.execute("SELECT * FROM clients ORDER BY name").fetchall()
+    # Fetch one extra row to know whether a next page exists.
+    clients = db.execute(
+        """
+        SELECT id, name, phone, birth_date, last_appointment, last_contacted
+        FROM clients
+        ORDER BY name
+        LIMIT ? OFFSET ?
+        """,
+        (CLIENTS_PAGE_SIZE + 1, (page - 1) * CLIENTS_PAGE_SIZE),
+    ).fetchall()
+    has_next = len(clients) > CLIENTS_PAGE_SIZE
     tasks = db.execute(
         """
-        SELECT tasks.*, clients.name, clients.phone
+        SELECT tasks.id, tasks.task_type, tasks.status, tasks.scheduled_for, clients.name, clients.phone
         FROM tasks
         JOIN clients ON clients.id = tasks.client_id
         ORDER BY tasks.created_at DESC
         LIMIT 50
         """
-    ).fetchall()
+    )
     logs = db.execute(
         """
-        SELECT message_log.*, clients.name
+        SELECT message_log.created_at, message_log.phone, message_log.message_type, message_log.status, clients.name
         FROM message_log
         LEFT JOIN clients ON clients.id = message_log.client_id
         ORDER BY message_log.created_at DESC
         LIMIT 20
         """
-    ).fetchall()
-    return render_template(
-        "index.html",
-        clients=clients,
-        tasks=tasks,
-        logs=logs,
-        stats=get_dashboard_stats(),
+    )
+    # Stream the page so the browser gets the top of it while the task and
+    # log cursors are still being consumed by the template.
+    return app.response_class(
+        stream_template(
+            "index.html",
+            clients=clients[:CLIENTS_PAGE_SIZE],
+            page=page,
+            has_next=has_next,
+            tasks=tasks,
+            logs=logs,
+            stats=stats,
+        )
     )
 
 
@@ -303,15 +555,15 @@ def create_client() -> str:
     last_contacted = request.form.get("last_contacted") or last_appointment or today_str()
     if not name or not phone:
         return redirect(url_for("index"))
-    db = get_db()
-    db.execute(
-        """
-        INSERT INTO clients (name, phone, birth_date, last_appointment, last_contacted, created_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
-        (name, phone, birth_date, last_appointment, last_contacted, datetime.now().isoformat()),
-    )
-    db.commit()
+    with write_db() as db:
+        db.execute(
+            """
+            INSERT INTO clients (name, phone, birth_date, last_appointment, last_contacted, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (name, phone, birth_date, last_appointment, last_contacted, datetime.now().isoformat()),
+        )
+        _reset_generation_marker(db)
     return redirect(url_for("index"))
 
 
@@ -324,26 +576,19 @@ def edit_client(client_id: int) -> str:
     last_contacted = request.form.get("last_contacted") or None
     if not name or not phone:
         return redirect(url_for("index"))
-    db = get_db()
-    db.execute(
-        """
-        UPDATE clients
-        SET name = ?, phone = ?, birth_date = ?, last_appointment = ?, last_contacted = ?
-        WHERE id = ?
-        """,
-        (name, phone, birth_date, last_appointment, last_contacted, client_id),
-    )
-    db.commit()
+    with write_db() as db:
+        db.execute(
+            UPDATE_CLIENT_SQL,
+            (name, phone, birth_date, last_appointment, last_contacted, client_id),
+        )
+        _reset_generation_marker(db)
     return redirect(url_for("index"))
 
 
 @app.route("/clients/<int:client_id>/delete", methods=["POST"])
 def delete_client(client_id: int) -> str:
-    db = get_db()
-    db.execute("DELETE FROM clients WHERE id = ?", (client_id,))
-    db.execute("DELETE FROM tasks WHERE client_id = ?", (client_id,))
-    db.execute("DELETE FROM message_log WHERE client_id = ?", (client_id,))
-    db.commit()
+    with write_db() as db:
+        db.execute("DELETE FROM clients WHERE id = ?", (client_id,))
     return redirect(url_for("index"))
 
 
@@ -352,11 +597,8 @@ def bulk_delete_clients() -> str:
     ids = request.form.getlist("client_ids")
     if not ids:
         return redirect(url_for("index"))
-    db = get_db()
-    db.executemany("DELETE FROM clients WHERE id = ?", [(cid,) for cid in ids])
-    db.executemany("DELETE FROM tasks WHERE client_id = ?", [(cid,) for cid in ids])
-    db.executemany("DELETE FROM message_log WHERE client_id = ?", [(cid,) for cid in ids])
-    db.commit()
+    with write_db() as db:
+        db.executemany("DELETE FROM clients WHERE id = ?", [(cid,) for cid in ids])
     return redirect(url_for("index"))
 
 
@@ -365,12 +607,12 @@ def bulk_done_tasks() -> str:
     ids = request.form.getlist("task_ids")
     if not ids:
         return redirect(url_for("index"))
-    db = get_db()
-    db.executemany(
-        "UPDATE tasks SET status = 'done', sent_at = COALESCE(sent_at, ?) WHERE id = ?",
-        [(datetime.now().isoformat(), tid) for tid in ids],
-    )
-    db.commit()
+    now_iso = datetime.now().isoformat()
+    with write_db() as db:
+        db.executemany(
+            UPDATE_TASK_STATUS_SQL,
+            [("done", now_iso, tid) for tid in ids],
+        )
     return redirect(url_for("index"))
 
 
@@ -379,44 +621,79 @@ def bulk_delete_tasks() -> str:
     ids = request.form.getlist("task_ids")
     if not ids:
         return redirect(url_for("index"))
-    db = get_db()
-    db.executemany("DELETE FROM tasks WHERE id = ?", [(tid,) for tid in ids])
-    db.commit()
+    with write_db() as db:
+        db.executemany("DELETE FROM tasks WHERE id = ?", [(tid,) for tid in ids])
+        _reset_generation_marker(db)
     return redirect(url_for("index"))
 
 
 @app.route("/tasks/<int:task_id>/toggle", methods=["POST"])
 def toggle_task(task_id: int) -> str:
-    db = get_db()
-    current = db.execute("SELECT status FROM tasks WHERE id = ?", (task_id,)).fetchone()
-    if not current:
-        return redirect(url_for("index"))
-    new_status = "done" if current["status"] != "done" else "pending"
-    db.execute(
-        "UPDATE tasks SET status = ?, sent_at = COALESCE(sent_at, ?) WHERE id = ?",
-        (new_status, datetime.now().isoformat(), task_id),
-    )
-    db.commit()
+    with write_db() as db:
+        current = db.execute("SELECT status FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        if not current:
+            return redirect(url_for("index"))
+        new_status = "done" if current["status"] != "done" else "pending"
+        db.execute(
+            UPDATE_TASK_STATUS_SQL,
+            (new_status, datetime.now().isoformat(), task_id),
+        )
     return redirect(url_for("index"))
 
 
-def send_promo_in_background(message: str, image_path: str | None = None) -> None:
-    with app.app_context():
-        db = get_db()
-        clients = db.execute("SELECT id, phone FROM clients").fetchall()
-        for client in clients:
-            delay = random.randint(10, 30)
-            time.sleep(delay)
-            try:
-                send_whatsapp_message(client["phone"], message, image_path=image_path)
-                db.execute(
-                    "UPDATE clients SET last_contacted = ? WHERE id = ?",
-                    (today_str(), client["id"]),
-                )
-                db.commit()
-                log_message(client["id"], client["phone"], message, "promo", "sent")
-            except Exception as exc:  # pragma: no cover - best effort
-                log_message(client["id"], client["phone"], message, "promo", "failed", str(exc))
+def send_one(client_id: int, message: str, image_path: str | None = None) -> None:
+    # The job may run long after the campaign was queued; skip clients that
+    # were deleted since, and use the phone as it is now.
+    with write_db() as db:
+        client = db.execute("SELECT phone FROM clients WHERE id = ?", (client_id,)).fetchone()
+    if client is None:
+        return
+    phone = client["phone"]
+    try:
+        send_whatsapp_message(phone, message, image_path=image_path)
+    except Exception as exc:  # pragma: no cover - best effort
+        log_message(client_id, phone, message, "promo", "failed", str(exc))
+        return
+    with write_db() as db:
+        db.execute(UPDATE_CLIENT_LAST_CONTACTED_SQL, (today_str(), client_id))
+        db.execute(
+            INSERT_LOG_SQL,
+            (client_id, phone, message, "promo", "sent", datetime.now().isoformat(), None),
+        )
+
+
+def _schedule_campaign_step(client_ids: list[int], message: str, image_path: str | None) -> None:
+    # The random 10-30s gap counts from now, i.e. from when the previous send
+    # finished, so a slow pywhatkit send never eats into the pause.
+    scheduler.add_job(
+        _run_campaign_step,
+        "date",
+        run_date=datetime.now() + timedelta(seconds=random.randint(10, 30)),
+        args=(client_ids, message, image_path),
+        executor="campaign",
+        misfire_grace_time=None,
+    )
+
+
+def _run_campaign_step(client_ids: list[int], message: str, image_path: str | None) -> None:
+    client_id, *remaining = client_ids
+    try:
+        send_one(client_id, message, image_path)
+    finally:
+        if remaining:
+            _schedule_campaign_step(remaining, message, image_path)
+
+
+def schedule_campaign(message: str, image_path: str | None = None) -> None:
+    # Each send is a one-shot scheduler job that queues the next client when
+    # it finishes, so no thread or connection is held for the whole campaign.
+    # Under `flask run` schedule_jobs() never ran, so start the scheduler
+    # here or the jobs would just sit in its queue.
+    ensure_scheduler_running()
+    db = get_db()
+    client_ids = [client_id for (client_id,) in db.execute("SELECT id FROM clients")]
+    if client_ids:
+        _schedule_campaign_step(client_ids, message, image_path)
 
 
 @app.route("/campaigns", methods=["POST"])
@@ -425,8 +702,7 @@ def send_campaign() -> str:
     image_path = request.form.get("image_path", "").strip() or None
     if not message:
         return redirect(url_for("index"))
-    thread = threading.Thread(target=send_promo_in_background, args=(message, image_path), daemon=True)
-    thread.start()
+    schedule_campaign(message, image_path)
     return redirect(url_for("index"))
 
 